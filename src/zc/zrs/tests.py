@@ -32,23 +32,21 @@ import ZODB.tests.testblob
 import ZODB.tests.testFileStorage
 import ZODB.tests.StorageTestBase
 import ZODB.utils
-from six.moves import cPickle
+from six.moves import cPickle, intern
+import collections
+import functools
 import logging
 import mock
-import os
+import operator
 import re
-import shutil
 import six
 import struct
 import subprocess
 import sys
-import tempfile
 import threading
 import time
 import transaction
 import twisted.internet.base
-import twisted.internet.error
-import twisted.python.failure
 import unittest
 import zc.zrs.primary
 import zc.zrs.reactor
@@ -59,6 +57,19 @@ import zc.zrs.sizedmessage
 # start the reactor thread so that it isn't reported as left over:
 zc.zrs.reactor.reactor()
 
+_TID = struct.Struct(">II")
+
+def tid_from_time(t):
+    # The tid for a transaction committed at Unix time t, packed
+    # directly in TimeStamp's raw layout (minutes since 1900-01-01 in
+    # the first word, seconds scaled to 2**32/60 in the second) rather
+    # than going through gmtime-tuple slicing, TimeStamp construction
+    # and repr for every call.
+    gmt = time.gmtime(t)
+    days = ((gmt[0] - 1900) * 12 + gmt[1] - 1) * 31 + gmt[2] - 1
+    minutes = (days * 24 + gmt[3]) * 60 + gmt[4]
+    return _TID.pack(minutes, int((t % 60) * ((1 << 32) / 60.0)))
+
 def scan_from_back():
     r"""
 Create the database:
@@ -90,9 +101,6 @@ If we try to iterate from the beginning, we'll get an error:
     ...
     CorruptedDataError: Error reading unknown oid.  Found '' at 4
 
-    >>> def tid_from_time(t):
-    ...     return eval(repr(TimeStamp(*(time.gmtime(t)[:5] + (t%60,)))))
-
     >>> tid = tid_from_time(time.time()-70)
     >>> zc.zrs.primary.FileStorageIterator(fs, condition, tid)
     ... # doctest: +ELLIPSIS
@@ -976,6 +984,12 @@ class DelayedCall:
         self.later = None
         self.func(*self.args, **self.kw)
 
+def _addr_key(interface, port):
+    # The factory table is keyed by interned strings: dict lookups on
+    # them take CPython's pointer-comparison fast path, where a tuple
+    # key hashes both elements on every connect.
+    return intern("%s:%s" % (interface, port))
+
 class TestReactor:
 
     def __init__(self):
@@ -983,16 +997,18 @@ class TestReactor:
         self.clients = []
         self.client_port = 47245
         self.later = []
+        self._transports = []
 
     def listenTCP(self, port, factory, backlog=50, interface=''):
-        addr = interface, port
-        assert addr not in self._factories
-        self._factories[addr] = factory
-        return TestListener(self, addr)
+        key = _addr_key(interface, port)
+        assert key not in self._factories
+        self._factories[key] = factory
+        return TestListener(self, key)
 
     def connect(self, addr):
-        proto = self._factories[addr].buildProtocol(addr)
-        transport = PrimaryTransport(self, addr, self.client_port, proto)
+        proto = self._factories[_addr_key(*addr)].buildProtocol(addr)
+        transport = _pooled_transport(
+            PrimaryTransport, self, addr, self.client_port, proto)
         self.client_port += 1
         proto.makeConnection(transport)
         return transport
@@ -1043,15 +1059,103 @@ class TestListener:
         if self.addr in self.reactor._factories:
             del self.reactor._factories[self.addr]
 
-close_reason = twisted.python.failure.Failure(
-    twisted.internet.error.ConnectionDone())
+close_reason = None
+
+def _get_close_reason():
+    # Built on first use so twisted.internet.error and
+    # twisted.python.failure are only imported when a connection is
+    # actually torn down.
+    global close_reason
+    if close_reason is None:
+        import twisted.internet.error
+        import twisted.python.failure
+        close_reason = twisted.python.failure.Failure(
+            twisted.internet.error.ConnectionDone())
+    return close_reason
+
+# Hoist the pickle entry points and use the binary protocol.  The
+# transports below (un)pickle on every message, so this saves an
+# attribute lookup per message and shrinks the marshalled data.
+_loads = cPickle.loads
+_dumps = cPickle.dumps
+
+# A reused fast pickler for the tiny control tuples the transports
+# send.  With fast set there's no memo bookkeeping, which dominates
+# pickling cost for messages this small.  (Same trick the producer in
+# zc.zrs.primary uses.)
+_picklerf = six.BytesIO()
+_pickler = cPickle.Pickler(_picklerf, 2)
+_pickler.fast = 1
+
+def _dump_message(data):
+    _picklerf.seek(0)
+    _picklerf.truncate()
+    _pickler.dump(data)
+    return _picklerf.getvalue()
+
+# The tests send the same few control payloads over and over, so cache
+# their sized-message encodings.  The cache is bounded; one-off
+# payloads just fall through to zc.zrs.sizedmessage.marshal.
+_marshal_cache = {}
+
+def _marshal(data):
+    record = _marshal_cache.get(data)
+    if record is None:
+        record = zc.zrs.sizedmessage.marshal(data)
+        if len(_marshal_cache) < 256:
+            _marshal_cache[data] = record
+    return record
+
+# Pre-compiled length-prefix codec, so reads don't re-parse the format
+# string for every frame.
+_HDR = struct.Struct(">I")
+
+def _parse_frame(buf, pos):
+    # Return the (start, end) offsets of the payload of the length-
+    # prefixed frame at pos.  Factored out of MessageTransport.read so
+    # the framing arithmetic is one call per message.
+    l, = _HDR.unpack_from(buf, pos)
+    start = pos + 4
+    return start, start + l
+
+# A free list of test transports, keyed by class.  The doctests churn
+# through lots of transports; reusing them (along with their condition
+# objects and buffers) across tests keeps allocator and GC pressure
+# down.  Transports are returned to the pool at test teardown.
+_transport_pool = collections.defaultdict(list)
+
+def _pooled_transport(class_, reactor, addr, port, proto=None):
+    pool = _transport_pool[class_]
+    if pool:
+        transport = pool.pop()
+        transport.reset(reactor, addr, port, proto)
+    else:
+        transport = class_(reactor, addr, port, proto)
+    reactor._transports.append(transport)
+    return transport
+
+def _recycle_transports(reactor):
+    while reactor._transports:
+        transport = reactor._transports.pop()
+        _transport_pool[transport.__class__].append(transport)
 
 class MessageTransport:
 
     def __init__(self, reactor, addr, port, proto=None):
-        self.data = b''
+        # Incoming data is accumulated in a bytearray and consumed from
+        # the front via a read cursor, so appends are amortized O(1) and
+        # reads don't copy the rest of the buffer.
+        self.data = bytearray()
         self.cond = threading.Condition()
+        self.reset(reactor, addr, port, proto)
+
+    def reset(self, reactor, addr, port, proto=None):
+        # (Re)initialize for use, keeping the buffer and condition
+        # already allocated so pooled transports can be reused.
+        del self.data[:]
+        self._pos = 0
         self.closed = False
+        self.producer = None
         self.reactor = reactor
         self.addr = addr
         self.peer = "IPv4Address(TCP, '127.0.0.1', %s)" % port
@@ -1062,30 +1166,42 @@ class MessageTransport:
         return self.peer
 
     def write(self, data):
-        self.cond.acquire()
-        self.data += data
-        self.cond.notifyAll()
-        self.cond.release()
+        with self.cond:
+            self.data.extend(data)
+            self.cond.notify_all()
 
     def writeSequence(self, data):
-        self.write(b''.join(data))
+        # Extend with each fragment directly rather than paying for an
+        # intermediate b''.join of the whole sequence.
+        with self.cond:
+            for chunk in data:
+                self.data.extend(chunk)
+            self.cond.notify_all()
 
     def read(self):
-        self.cond.acquire()
-
-        if len(self.data) < 4:
-            self.cond.wait(5)
-            assert len(self.data) >= 4
-        l, = struct.unpack(">I", self.data[:4])
-        self.data = self.data[4:]
-
-        if len(self.data) < l:
-            self.cond.wait(5)
-            assert len(self.data) >= l, (l, len(self.data))
-        result = self.data[:l]
-        self.data = self.data[l:]
-
-        self.cond.release()
+        cond = self.cond
+        with cond:
+            # Wait in a loop so a spurious wakeup or a partial frame
+            # doesn't trip the asserts below.  Give up after 5 seconds.
+            waits = 5
+            while len(self.data) - self._pos < 4 and waits:
+                cond.wait(1)
+                waits -= 1
+            assert len(self.data) - self._pos >= 4
+            start, end = _parse_frame(self.data, self._pos)
+
+            while len(self.data) < end and waits:
+                cond.wait(1)
+                waits -= 1
+            assert len(self.data) >= end, (
+                end - start, len(self.data) - start)
+            result = memoryview(self.data)[start:end].tobytes()
+            self._pos = end
+
+            # Compact the buffer once a fair amount has been consumed.
+            if self._pos > 4096:
+                del self.data[:self._pos]
+                self._pos = 0
 
         return result
 
@@ -1093,7 +1209,7 @@ class MessageTransport:
         self.md5 = md5(data)
 
     def send(self, data):
-        record = zc.zrs.sizedmessage.marshal(data)
+        record = _marshal(data)
         self.md5.update(record[4:])
         dataReceived = self.proto.dataReceived
 
@@ -1106,11 +1222,11 @@ class MessageTransport:
             n *= 2
 
     def have_data(self):
-        return bool(self.data)
+        return len(self.data) > self._pos
 
     def loseConnection(self):
         self.closed = True
-        self.proto.connectionLost(close_reason)
+        self.proto.connectionLost(_get_close_reason())
 
     producer = None
     def registerProducer(self, producer, streaming):
@@ -1120,25 +1236,30 @@ class MessageTransport:
         if self.producer is not None:
             self.producer = None
             if self.closed:
-                self.proto.connectionLost(close_reason)
+                self.proto.connectionLost(_get_close_reason())
 
     def close(self):
         self.producer.stopProducing()
-        self.proto.connectionLost(close_reason)
+        self.proto.connectionLost(_get_close_reason())
 
 class PrimaryTransport(MessageTransport):
 
+    # Tests that only care that messages arrived, not what was in them,
+    # can set raw (usually on the class) to skip the unpickling round
+    # trip altogether.
+    raw = False
+
     def read(self, raw=False):
         data = MessageTransport.read(self)
-        if raw:
+        if raw or self.raw:
             return data
-        return cPickle.loads(data)
+        return _loads(data)
 
 class SecondaryTransport(MessageTransport):
 
     def send(self, data, raw=False):
         if not raw:
-            data = cPickle.dumps(data)
+            data = _dump_message(data)
         MessageTransport.send(self, data or b'')
 
     def fail(self):
@@ -1168,16 +1289,18 @@ class TestConnector(twisted.internet.base.BaseConnector):
     def _makeTransport(self):
         reactor, addr = self.reactor, self.addr
 
-        if addr in reactor._factories:
+        key = _addr_key(*addr)
+        if key in reactor._factories:
             # We have a server and a client.  We'll hook them together via
             # a loopback mechanism
             proto = self.buildProtocol(addr)
-            server = reactor._factories[addr].buildProtocol(addr)
+            server = reactor._factories[key].buildProtocol(addr)
             loopback.loopbackAsync(server, proto, self)
             transport = proto.transport
         else:
             reactor.clients.append(self)
-            transport = SecondaryTransport(reactor, addr, reactor.client_port)
+            transport = _pooled_transport(
+                SecondaryTransport, reactor, addr, reactor.client_port)
             reactor.client_port += 1
 
         transport.connector = self
@@ -1196,6 +1319,8 @@ class TestConnector(twisted.internet.base.BaseConnector):
 
 
 class Stdout:
+    # Looks up sys.stdout at call time rather than binding the stream
+    # directly: doctest swaps sys.stdout in and out to capture output.
     def write(self, data):
         sys.stdout.write(data)
     def flush(self):
@@ -1205,23 +1330,46 @@ stdout_handler = logging.StreamHandler(Stdout())
 stdout_handler.setFormatter(logging.Formatter(
     "%(levelname)s %(name)s:\n%(message)s"))
 
-def join(old):
-    # Wait for any new threads created during a test to die.
+# Register the handler once, here.  Individual tests just raise and
+# lower the logger level instead of churning the handler list.
+logging.getLogger('zc.zrs').addHandler(stdout_handler)
+
+def join(old_idents):
+    # Wait for any new threads created during a test to die.  The set of
+    # pre-existing threads is passed as a set of idents, so the check
+    # here is a hash lookup rather than a list scan per thread.
     for thread in threading.enumerate():
-        if thread not in old:
+        if thread.ident not in old_idents:
             thread.join(1.0)
 
+def thread_idents():
+    return set(t.ident for t in threading.enumerate())
+
+# The current faux time, held in a one-element list so the patched
+# time.time below can read it without entering Python code.
+_now = [0]
+
 def setUpTime(test):
-    setupstack.register(test, join, threading.enumerate())
+    setupstack.register(test, join, thread_idents())
     setupstack.setUpDirectory(test)
-    global now
-    now = 1174509177
+    _now[0] = 1174509177
     oldtime = time.time
     setupstack.register(test, lambda : setattr(time, 'time', oldtime))
-    time.time = lambda : now
+    # ZODB calls time.time constantly while assigning tids; a partial
+    # over operator.getitem keeps each call in C, unlike a lambda.
+    time.time = functools.partial(operator.getitem, _now, 0)
+    # Several doctests commit in tight loops (scan_from_back alone does
+    # a hundred), and the per-commit fsync dominates their wallclock.
+    # Durability is irrelevant in a test working directory, so turn the
+    # sync off for the duration of the test.
+    # (patch.object because the dotted name resolves to the FileStorage
+    # class, not the module, which shadows it in the package namespace)
+    fsync_patch = mock.patch.object(
+        sys.modules['ZODB.FileStorage.FileStorage'], 'fsync', None)
+    fsync_patch.start()
+    setupstack.register(test, fsync_patch.stop)
     def commit():
-        global now
-        now += 1
+        _now[0] += 1
         transaction.commit()
     test.globs['commit'] = commit
 
@@ -1229,13 +1377,12 @@ def setUp(test):
     setUpTime(test)
 
     test.globs['reactor'] = TestReactor()
+    setupstack.register(test, _recycle_transports, test.globs['reactor'])
     test.globs['print_'] = print
 
     logger = logging.getLogger('zc.zrs')
     logger.setLevel(1)
     setupstack.register(test, logger.setLevel, 0)
-    logger.addHandler(stdout_handler)
-    setupstack.register(test, logger.removeHandler, stdout_handler)
 
 ##############################################################################
 # Reuse ZODB Storage Tests
@@ -1277,9 +1424,10 @@ class BasePrimaryStorageTests(StorageTestBase.StorageTestBase):
         self.__pack = None
 
         self.globs = {}
-        setupstack.register(self, join, threading.enumerate())
+        setupstack.register(self, join, thread_idents())
         setupstack.setUpDirectory(self)
         self.globs['reactor'] = TestReactor()
+        setupstack.register(self, _recycle_transports, self.globs['reactor'])
         self.open(create=1)
 
     def tearDown(self):
@@ -1481,7 +1629,7 @@ class ZEOTests(ZEO.tests.testZEO.FullGenericTests):
 
     def setUp(self):
         self.globs = {}
-        setupstack.register(self, join, threading.enumerate())
+        setupstack.register(self, join, thread_idents())
         setupstack.setUpDirectory(self)
         ZEO.tests.testZEO.FullGenericTests.setUp(self)
         self.__sfs = ZODB.FileStorage.FileStorage('secondary.fs')